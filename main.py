@@ -1,12 +1,41 @@
 import os
 import json
 import sys
-import math
-from datetime import datetime, timedelta, timezone
+import functools
+import hashlib
+from datetime import datetime, time, timedelta, timezone
+from pathlib import Path
+from zoneinfo import ZoneInfo
 import yfinance as yf
 import pandas as pd
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjsonがあれば高速なシリアライザを使い、無ければ標準のjsonで代用する (いずれもnumpy型に対応)
+# _dumpsは文字列(HTML埋め込み用)、_dumpbはUTF-8のバイト列(HTTP送信用)を返す
+try:
+    import orjson
+
+    def _dumpb(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def _dumps(obj):
+        return _dumpb(obj).decode("utf-8")
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj, separators=(",", ":"), default=lambda o: o.tolist())
+
+    def _dumpb(obj):
+        return _dumps(obj).encode("utf-8")
+
+# numbaがあれば数値計算カーネルをJITコンパイルし、無ければ通常のPython関数として実行する
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
 
 # ==========================================
 # 1. 設定と定数定義
@@ -46,32 +75,101 @@ SECTORS = [
     {"code": "XLU",  "name": "公益事業",     "clock": 8.5,  "area": "SW"},
 ]
 
-PHASES = {
-    "回復期": {"x_sign": -1, "y_sign": 1},
-    "好況期": {"x_sign": 1,  "y_sign": 1},
-    "後退期": {"x_sign": 1,  "y_sign": -1},
-    "不況期": {"x_sign": -1, "y_sign": -1},
-}
+# セクターごとの単位ベクトル (SECTORSの並び順で固定、時計位置を角度へ変換)
+_CLOCK = np.array([s["clock"] for s in SECTORS])
+_RAD = np.radians(90.0 - _CLOCK * 30.0)
+_UX = np.cos(_RAD)
+_UY = np.sin(_RAD)
+_CODE_ORDER = [s["code"] for s in SECTORS]
+
+# 取得データのキャッシュ保存先
+CACHE_DIR = ".cache"
+
+# 価格をキャッシュしてよい時刻 (米国東部時間、16:00のクローズ後に終値が確定するまで余裕を見る)
+US_EASTERN = ZoneInfo("America/New_York")
+US_CLOSE_CACHE_TIME = time(16, 30)
+
+# フェーズ判定表 [y >= 0][x >= 0]
+_PHASE_TABLE = [
+    ["不況期", "後退期"],
+    ["回復期", "好況期"],
+]
 
 # ==========================================
 # 2. 計算ロジック
 # ==========================================
 
+def daily_cache(func):
+    """
+    戻り値のDataFrameを日付単位でディスクにキャッシュするデコレータ。
+    呼び出し時のキーワード引数cache_dateをキャッシュのキーとして受け取り(対象関数には渡さない)、
+    同じ日付での再実行ではネットワークを使わずキャッシュを返す。cache_dateがNoneなら毎回取得する。
+    """
+    @functools.wraps(func)
+    def wrapper(*args, cache_date, **kwargs):
+        if cache_date is None:
+            return func(*args, **kwargs)
+        
+        cache_path = os.path.join(CACHE_DIR, f"{func.__name__}_{cache_date:%Y%m%d}.pkl")
+        if os.path.exists(cache_path):
+            print(f"Loading cache: {cache_path}")
+            return pd.read_pickle(cache_path)
+        
+        df = func(*args, **kwargs)
+
+        # 空データや最新行に欠損がある(取得失敗・未反映のティッカーを含む)結果はキャッシュせず、再実行時に取り直す
+        if df.empty or df.iloc[-1].isna().any():
+            print("Warning: Fetched data is incomplete. Skipping cache.")
+            return df
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # 前日以前のキャッシュは不要なので削除
+        for old_path in Path(CACHE_DIR).glob(f"{func.__name__}_*.pkl"):
+            old_path.unlink()
+        df.to_pickle(cache_path)
+        return df
+    return wrapper
+
+@daily_cache
 def get_market_data():
     tickers = [s["code"] for s in SECTORS]
     print(f"Fetching US Sector Data: {tickers}")
     
-    # 過去2年分取得
-    df = yf.download(tickers, period="2y", interval="1d", progress=False)['Close']
+    # 過去2年分を1回の一括リクエストで取得 (ティッカーごとに並列ダウンロード)
+    df = yf.download(tickers, period="2y", interval="1d", progress=False, threads=True)['Close']
     
     # MultiIndexカラムのフラット化（yfinanceのバージョン差異対策）
     if isinstance(df.columns, pd.MultiIndex):
         df.columns = df.columns.get_level_values(0)
-        
-    df = df.ffill().bfill()
+
+    # 取得に失敗したティッカーも欠損の列として残し、キャッシュ判定で検出できるようにする
+    df = df.reindex(columns=tickers)
+    failed = [code for code in tickers if df[code].isna().all()]
+    if failed:
+        print(f"Warning: No data for {failed}")
+    
+    # 欠損補完はキャッシュ判定の後 (fill_pricesで行う)
     return df
 
-def check_market_open(latest_date_timestamp):
+def fill_prices(df):
+    # 欠損補完はコピーを作らずその場で行う
+    df.ffill(inplace=True)
+    df.bfill(inplace=True)
+    
+    # 出力は小数2桁なのでfloat32で十分 (移動平均計算のメモリ帯域を半減)
+    return df.astype(np.float32)
+
+def market_cache_date(run_ts):
+    """
+    価格キャッシュのキーとする米国の取引日を返す。
+    取引時間中の価格は終値ではないため、クローズ後(US_CLOSE_CACHE_TIME)より前はNone(キャッシュしない)を返す。
+    """
+    run_ts_et = run_ts.astimezone(US_EASTERN)
+    if run_ts_et.time() < US_CLOSE_CACHE_TIME:
+        return None
+    return run_ts_et.date()
+
+def check_market_open(latest_date_timestamp, run_ts):
     """
     データの最新日付と現在日時を比較し、休場日でないか判定する。
     実行はUTC 21:00 (米国市場クローズ後)。
@@ -79,7 +177,7 @@ def check_market_open(latest_date_timestamp):
     2日以上古い場合は休場とみなして中断する。
     """
     latest_date = latest_date_timestamp.date()
-    today = datetime.now(timezone.utc).date()
+    today = run_ts.date()
     
     diff = (today - latest_date).days
     print(f"Data Date: {latest_date}, Execution Date(UTC): {today}, Diff: {diff} days")
@@ -89,48 +187,48 @@ def check_market_open(latest_date_timestamp):
         return False
     return True
 
-def clock_to_rad(clock_hour):
-    degree = 90 - (clock_hour * 30)
-    return math.radians(degree)
-
-def calculate_vector(df, target_date):
-    data_until = df[df.index <= target_date]
-    if len(data_until) < 200:
-        return None, None
-    
-    current_prices = data_until.iloc[-1]
-    ma200 = data_until.iloc[-200:].mean()
-    deviations = (current_prices - ma200) / ma200 * 100
+@njit(cache=True)
+def compute_trajectory(prices, ux, uy, idxs):
+    """
+    価格行列(営業日×セクター)から、idxs行目(営業日の位置)それぞれの座標をまとめて求める。
+    各位置で200日移動平均乖離率を計算し、セクターごとの単位ベクトルで合成する。
+    idxsは昇順で、いずれも199以上であること。
+    """
+    n_sectors = prices.shape[1]
+    out = np.empty((len(idxs), 2), dtype=np.float64)
     
-    total_x = 0
-    total_y = 0
+    # 直近200日の価格合計 (最初の位置で1度だけ集計し、以降は差分で更新する)
+    ma_sum = np.zeros(n_sectors)
+    prev = idxs[0]
+    for j in range(prev - 199, prev + 1):
+        ma_sum += prices[j]
     
-    for sector in SECTORS:
-        code = sector["code"]
-        if code not in deviations: continue
-        
-        strength = deviations[code]
-        rad = clock_to_rad(sector["clock"])
+    for k in range(len(idxs)):
+        i = idxs[k]
         
-        x = strength * math.cos(rad)
-        y = strength * math.sin(rad)
+        # 200日移動平均 (入った日を足し、窓から外れた日を引く)
+        for j in range(prev + 1, i + 1):
+            ma_sum += prices[j]
+            ma_sum -= prices[j - 200]
+        prev = i
+        ma = ma_sum / 200.0
+        dev = (prices[i] - ma) / ma * 100.0
         
-        total_x += x
-        total_y += y
+        # 欠損セクターは寄与0として合成
+        dev = np.nan_to_num(dev)
         
-    # スケール調整 (US ETF向け)
-    scale_factor = 3.5 
-    return total_x / scale_factor, total_y / scale_factor
+        # スケール調整 (US ETF向け)
+        scale_factor = 3.5
+        out[k, 0] = (dev * ux).sum() / scale_factor
+        out[k, 1] = (dev * uy).sum() / scale_factor
+    return out
 
 # ==========================================
 # 3. HTML生成 (GitHub Pages用)
 # ==========================================
 
-def create_standalone_html(history_points, current_point, last_date_str):
-    history_json = json.dumps(history_points)
-    current_json = json.dumps([current_point])
-    
-    html = f"""<!DOCTYPE html>
+# プレースホルダー {{XS}}, {{YS}}, {{CURRENT}} を実行時に置換する
+_HTML_TEMPLATE = """<!DOCTYPE html>
 <html lang="ja">
 <head>
     <meta charset="UTF-8">
@@ -138,9 +236,9 @@ def create_standalone_html(history_points, current_point, last_date_str):
     <title>US Sector Cycle Chart</title>
     <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
     <style>
-        body {{ margin: 0; padding: 0; display: flex; justify-content: center; align-items: center; height: 100vh; background-color: #fff; font-family: sans-serif; }}
-        .chart-container {{ position: relative; width: 100vw; max-width: 600px; aspect-ratio: 1; }}
-        canvas {{ width: 100% !important; height: 100% !important; }}
+        body { margin: 0; padding: 0; display: flex; justify-content: center; align-items: center; height: 100vh; background-color: #fff; font-family: sans-serif; }
+        .chart-container { position: relative; width: 100vw; max-width: 600px; aspect-ratio: 1; }
+        canvas { width: 100% !important; height: 100% !important; }
     </style>
 </head>
 <body>
@@ -148,19 +246,23 @@ def create_standalone_html(history_points, current_point, last_date_str):
         <canvas id="usSectorCycleChart"></canvas>
     </div>
     <script>
-    document.addEventListener("DOMContentLoaded", function() {{
+    document.addEventListener("DOMContentLoaded", function() {
         var ctx = document.getElementById('usSectorCycleChart');
         
-        const sectorLabels = {{
+        // 軌跡はx, y座標の配列で受け取り、Chart.js用の点に組み立てる
+        const xs = {{XS}};
+        const ys = {{YS}};
+        
+        const sectorLabels = {
             NW: ["テクノロジー", "一般消費財", "通信"],
             NE: ["資本財", "素材", "金融"],
             SE: ["エネルギー", "不動産"],
             SW: ["ヘルスケア", "生活必需品", "公益"]
-        }};
+        };
 
-        var bgPlugin = {{
+        var bgPlugin = {
             id: 'bgPlugin',
-            beforeDraw: function(chart) {{
+            beforeDraw: function(chart) {
                 var ctx = chart.ctx;
                 var ca = chart.chartArea;
                 var x = chart.scales.x;
@@ -226,68 +328,68 @@ def create_standalone_html(history_points, current_point, last_date_str):
                 sectorLabels.SW.slice().reverse().forEach((t, i) => ctx.fillText(t, ca.left + pad, ca.bottom - pad - (i * lh)));
 
                 ctx.restore();
-            }}
-        }};
+            }
+        };
 
-        new Chart(ctx, {{
+        new Chart(ctx, {
             type: 'scatter',
-            data: {{
+            data: {
                 datasets: [
-                    {{
+                    {
                         // 軌跡 (線のみ)
                         label: '軌跡',
-                        data: {history_json},
+                        data: xs.map((x, i) => ({x: x, y: ys[i]})),
                         borderWidth: 2,
                         pointRadius: 0, // 点は描画しない
                         showLine: true,
-                        segment: {{
+                        segment: {
                             // 過去から現在に向かって濃くなるグラデーション
-                            borderColor: function(ctx) {{
+                            borderColor: function(ctx) {
                                 var count = ctx.chart.data.datasets[0].data.length;
                                 var val = ctx.p1DataIndex / count;
                                 var alpha = 0.1 + (0.9 * val);
                                 return 'rgba(80, 80, 80, ' + alpha + ')';
-                            }}
-                        }},
+                            }
+                        },
                         order: 2
-                    }},
-                    {{
+                    },
+                    {
                         // 現在地 (点のみ)
                         label: '現在',
-                        data: {current_json},
+                        data: {{CURRENT}},
                         backgroundColor: 'rgba(255, 0, 0, 1)',
                         borderColor: '#fff',
                         borderWidth: 2,
                         pointRadius: 8,
                         pointHoverRadius: 10,
                         order: 1
-                    }}
+                    }
                 ]
-            }},
-            options: {{
+            },
+            options: {
                 responsive: true,
                 maintainAspectRatio: false,
-                scales: {{
-                    x: {{ min: -25, max: 25, grid: {{ display: false }}, ticks: {{ display: false }} }},
-                    y: {{ min: -25, max: 25, grid: {{ display: false }}, ticks: {{ display: false }} }}
-                }},
-                plugins: {{ legend: {{display: false}}, tooltip: {{enabled: false}} }}
-            }},
+                scales: {
+                    x: { min: -25, max: 25, grid: { display: false }, ticks: { display: false } },
+                    y: { min: -25, max: 25, grid: { display: false }, ticks: { display: false } }
+                },
+                plugins: { legend: {display: false}, tooltip: {enabled: false} }
+            },
             plugins: [bgPlugin]
-        }});
-    }});
+        });
+    });
     </script>
 </body>
 </html>"""
-    return html
 
-def generate_wp_content(config, last_date_str, current_phase):
-    pages_url = config.get("gh", "#")
-    timestamp = datetime.now().strftime('%Y%m%d%H%M')
-    iframe_src = f"{pages_url}index.html?v={timestamp}"
+def create_standalone_html(xs, ys, current_point, last_date_str):
+    return (_HTML_TEMPLATE
+        .replace("{{XS}}", _dumps(xs))
+        .replace("{{YS}}", _dumps(ys))
+        .replace("{{CURRENT}}", _dumps([current_point])))
 
-    # セクター解説
-    details_html = """
+# セクター解説
+_WP_DETAILS_HTML = """
     <div style="font-size:0.9em; margin-top:15px; background:#f9f9f9; padding:10px; border:1px solid #eee; border-radius:4px;">
         <p><strong>採用セクター (S&P500)</strong></p>
         <ul style="padding-left: 20px; margin-top:5px; list-style-type: disc;">
@@ -303,20 +405,32 @@ def generate_wp_content(config, last_date_str, current_phase):
     </div>
     """
 
-    wp_html = f"""
-    <h3>米国市場 セクターローテーション {last_date_str}</h3>
-    <p>現在の重心は<strong>【{current_phase}】</strong>エリアにあります。<br>
+# プレースホルダー {{LAST_DATE}}, {{PHASE}}, {{IFRAME_SRC}}, {{DETAILS}} を実行時に置換する
+_WP_TEMPLATE = """
+    <h3>米国市場 セクターローテーション {{LAST_DATE}}</h3>
+    <p>現在の重心は<strong>【{{PHASE}}】</strong>エリアにあります。<br>
     S&P500主要11セクターのモメンタムを解析し、過去1年間の景気循環の軌跡を描画しています。<br>中心から離れるほどトレンドが強く、中心に近いほど方向感がないことを意味します。</p>
     <div style="width: 100%; max-width: 600px; aspect-ratio: 1; margin: 0 auto; border: 1px solid #eee; overflow: hidden; box-shadow: 0 2px 5px rgba(0,0,0,0.05);">
-        <iframe src="{iframe_src}" width="100%" height="100%" style="border:none; display:block;" title="US Sector Cycle Chart"></iframe>
+        <iframe src="{{IFRAME_SRC}}" width="100%" height="100%" style="border:none; display:block;" title="US Sector Cycle Chart"></iframe>
     </div>
     <div style="height:20px" aria-hidden="true" class="wp-block-spacer"></div>
     
     <details class="wp-block-details" style="border: 1px solid #ddd; padding: 10px; cursor: pointer;">
         <summary style="font-weight: bold; outline: none;">▼ 詳細データと解説（クリックで開閉）</summary>
-        {details_html}
+        {{DETAILS}}
     </details>
     """
+
+def generate_wp_content(config, last_date_str, current_phase, chart_version):
+    pages_url = config.get("gh", "#")
+    # キャッシュ回避用のクエリはグラフ内容のハッシュ (内容が変わらなければ本文も変わらない)
+    iframe_src = f"{pages_url}index.html?v={chart_version}"
+
+    wp_html = (_WP_TEMPLATE
+        .replace("{{LAST_DATE}}", last_date_str)
+        .replace("{{PHASE}}", current_phase)
+        .replace("{{IFRAME_SRC}}", iframe_src)
+        .replace("{{DETAILS}}", _WP_DETAILS_HTML))
     return wp_html
 
 # ==========================================
@@ -324,87 +438,94 @@ def generate_wp_content(config, last_date_str, current_phase):
 # ==========================================
 
 def main():
+    # 実行時刻は1度だけ取得して各処理で共有する
+    run_ts = datetime.now(timezone.utc)
     config = load_secrets()
     
     # データ取得
     try:
-        df = get_market_data()
+        df = fill_prices(get_market_data(cache_date=market_cache_date(run_ts)))
     except Exception as e:
         print(f"Error fetching data: {e}")
         sys.exit(1)
 
     # 休日判定
     latest_date_timestamp = df.index[-1]
-    if not check_market_open(latest_date_timestamp):
+    if not check_market_open(latest_date_timestamp, run_ts):
         sys.exit(0) # エラーではなく正常終了として処理をスキップ
 
     last_date_str = latest_date_timestamp.strftime('%Y年%m月%d日')
     
+    # 価格行列 (列はSECTORSの並び順に揃える)
+    prices = df.reindex(columns=_CODE_ORDER).to_numpy()
+    
+    # 現在地の計算にも200日分の履歴が必要
+    if len(prices) < 200:
+        print("Error: Calculation failed.")
+        sys.exit(1)
+    
     # 軌跡計算 (365日前から10日刻み)
-    history_points = []
     end_date = latest_date_timestamp
     start_date = end_date - timedelta(days=365)
     
-    # 10日ごとの日付生成
+    # 10日ごとに日付を生成し、データが存在する直近の営業日の位置へ一括で寄せる
     dates = pd.date_range(start=start_date, end=end_date, freq='10D')
+    idxs = df.index.get_indexer(dates, method='pad')
+    idxs = idxs[idxs >= 199] # 200日分の履歴があるものだけ
     
-    for d in dates:
-        # データが存在する直近の日付を探す
-        if d not in df.index:
-            past_matches = df.index[df.index <= d]
-            if len(past_matches) == 0: continue
-            valid_date = past_matches[-1]
-        else:
-            valid_date = d  
-            
-        x, y = calculate_vector(df, valid_date)
-        if x is not None:
-            history_points.append({"x": round(x, 2), "y": round(y, 2)})
-            
-    # 現在地計算 (最新日付)
-    curr_x, curr_y = calculate_vector(df, latest_date_timestamp)
-    if curr_x is None:
-        print("Error: Calculation failed.")
-        sys.exit(1)
-
-    current_point = {"x": round(curr_x, 2), "y": round(curr_y, 2)}
+    # 軌跡の最後に現在地(最新日付)を追加してつなげる
+    idxs = np.append(idxs, len(prices) - 1)
+    trajectory = compute_trajectory(prices, _UX, _UY, idxs)
+    x_arr, y_arr = trajectory[:, 0], trajectory[:, 1]
+    xs = np.round(x_arr, 2).tolist()
+    ys = np.round(y_arr, 2).tolist()
     
-    # 軌跡の最後に現在地を追加してつなげる
-    history_points.append(current_point)
+    curr_x, curr_y = x_arr[-1], y_arr[-1]
+    current_point = {"x": xs[-1], "y": ys[-1]}
 
     # フェーズ判定
-    current_phase = "不明"
-    c_x_sign = 1 if curr_x >= 0 else -1
-    c_y_sign = 1 if curr_y >= 0 else -1
-    for name, signs in PHASES.items():
-        if signs["x_sign"] == c_x_sign and signs["y_sign"] == c_y_sign:
-            current_phase = name
-            break
+    current_phase = _PHASE_TABLE[int(curr_y >= 0)][int(curr_x >= 0)]
             
     print(f"US Market Phase: {current_phase} (x={curr_x:.2f}, y={curr_y:.2f})")
 
     # GitHub Pages用HTML生成
-    chart_html = create_standalone_html(history_points, current_point, last_date_str)
+    chart_html = create_standalone_html(xs, ys, current_point, last_date_str)
     
-    output_dir = "public"
-    os.makedirs(output_dir, exist_ok=True)
-    with open(os.path.join(output_dir, "index.html"), "w", encoding="utf-8") as f:
-        f.write(chart_html)
+    output_dir = Path("public")
+    output_dir.mkdir(exist_ok=True)
+    (output_dir / "index.html").write_text(chart_html, encoding="utf-8")
     print(f"Generated public/index.html")
 
     # WordPress更新
-    wp_content = generate_wp_content(config, last_date_str, current_phase)
+    chart_version = hashlib.blake2b(chart_html.encode("utf-8"), digest_size=8).hexdigest()
+    wp_content = generate_wp_content(config, last_date_str, current_phase, chart_version)
     
     # キー名は短縮形: h=URL, pid=PageID, u=User, p=Pass
     wp_url = f"{config['h']}/wp-json/wp/v2/pages/{config['pid']}"
+    
+    # 前回更新時と更新先・本文が同じ(同日の再実行などでデータが変わらない場合)なら更新を省略
+    wp_hash = hashlib.blake2b(f"{wp_url}\n{wp_content}".encode("utf-8"), digest_size=16).hexdigest()
+    wp_hash_path = Path(CACHE_DIR) / "last_wp_hash"
+    if wp_hash_path.exists() and wp_hash_path.read_text(encoding="utf-8") == wp_hash:
+        print("Unchanged, skipping WordPress update.")
+        return
+    
     auth = (config['u'], config['p'])
-    payload = {'content': wp_content}
+    payload = _dumpb({'content': wp_content})
+    headers = {'Content-Type': 'application/json'}
+    
+    # 一時的なサーバーエラーはバックオフ付きで再試行 (ページ内容の上書きなので再送しても安全)
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504], allowed_methods=["POST"])
+    session.mount("https://", HTTPAdapter(max_retries=retry))
     
     print(f"Updating WordPress Page ID: {config['pid']}...")
     try:
-        response = requests.post(wp_url, json=payload, auth=auth)
+        response = session.post(wp_url, data=payload, headers=headers, auth=auth, timeout=30)
         response.raise_for_status()
         print("Success! WordPress updated.")
+        wp_hash_path.parent.mkdir(exist_ok=True)
+        wp_hash_path.write_text(wp_hash, encoding="utf-8")
     except requests.exceptions.RequestException as e:
         print(f"Error updating WordPress: {e}")
         sys.exit(1)